@@ -1,15 +1,26 @@
 import streamlit as st
 import sqlite3
 import os
-from datetime import datetime
-from typing import List
+import re
+from html import escape
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
 
 from dotenv import load_dotenv
 load_dotenv()
 
 from langchain_groq import ChatGroq
-from langchain_core.prompts import ChatPromptTemplate
-from pydantic import BaseModel, Field
+from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.prompts import PromptTemplate
+
+# -------- Models (importable, so the class survives script reruns) --------
+from models import CompanyReport
 
 # -------- Tavily --------
 from tavily import TavilyClient
@@ -21,43 +32,99 @@ from reportlab.lib.pagesizes import A4
 
 
 
-conn = sqlite3.connect("companyDB.db", check_same_thread=False)
-cursor = conn.cursor()
+class ConnectionPool:
+    """One writer connection plus a small pool of read-only connections."""
+
+    PRAGMAS = """
+    PRAGMA busy_timeout=5000;
+    PRAGMA cache_size=-65536;
+    PRAGMA foreign_keys=ON;
+    PRAGMA temp_store=MEMORY;
+    """
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers = readers
+        self.opened = 0
+        self.read_conns = queue.Queue()
+        self.open_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.write_conn = sqlite3.connect(
+            path,
+            check_same_thread=False,
+            isolation_level="IMMEDIATE"  # take the write lock at BEGIN, avoids SQLITE_BUSY mid-transaction
+        )
+        self.write_conn.executescript(
+            "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;" + self.PRAGMAS
+        )
+
+    def _open_reader(self):
+        read_conn = sqlite3.connect(
+            f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+        )
+        read_conn.executescript("PRAGMA query_only=1;" + self.PRAGMAS)
+        return read_conn
+
+    @contextmanager
+    def writer(self):
+        with self.write_lock:
+            yield self.write_conn
+
+    @contextmanager
+    def reader(self):
+        # readers are opened lazily so the database file exists by then
+        with self.open_lock:
+            if self.read_conns.empty() and self.opened < self.readers:
+                self.opened += 1
+                self.read_conns.put(self._open_reader())
+        read_conn = self.read_conns.get()
+        try:
+            yield read_conn
+        finally:
+            self.read_conns.put(read_conn)
 
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS reports (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    company TEXT,
-    pdf_path TEXT,
-    created_at TEXT
-)
-""")
-conn.commit()
 
+HISTORY_PAGE_SIZE = 50
 
 
-llm = ChatGroq(
-    model="llama-3.3-70b-versatile",
-    temperature=0
-)
+@st.cache_resource(show_spinner=False)
+def get_db() -> ConnectionPool:
+    db = ConnectionPool("companyDB.db")
+    with db.writer() as conn, conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            company TEXT,
+            pdf_path TEXT,
+            created_at TEXT
+        )
+        """)
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_reports_created_at ON reports(created_at DESC)"
+        )
+    return db
 
 
+@st.cache_resource(show_spinner=False)
+def get_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4)
 
 
-class CompanyReport(BaseModel):
-    company_overview: str
-    recent_developments: List[str]
-    earnings_summary: str
-    future_plans: str
-    stock_context: str
-    sources: List[str]
+@st.cache_resource(show_spinner=False)
+def get_tavily() -> TavilyClient:
+    return TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
 
 
-    risks_and_limitations: str = Field(
-        description="Key risks, uncertainties, and data limitations"
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    llm = ChatGroq(
+        model="llama-3.3-70b-versatile",
+        temperature=0,
+        timeout=20,  # a stalled completion is abandoned and retried by the client
+        max_retries=2
     )
-    confidence_level: str = Field(
-        description="HIGH / MEDIUM / LOW confidence with brief justification"
+    return llm.with_structured_output(
+        CompanyReport, method="function_calling", include_raw=False
     )
 
 
@@ -68,18 +135,56 @@ def limit_text(text, max_chars=2500):
     return str(text)[:max_chars]
 
 
-def tavily_text(result: dict) -> str:
+def tavily_text(result: dict, max_chars=2500) -> str:
     if not result or "results" not in result:
         return ""
-    return " ".join(
-        item.get("content", "") for item in result["results"]
+    parts, size = [], 0
+    for item in result["results"]:
+        content = item.get("content", "")
+        parts.append(content)
+        size += len(content) + 1
+        if size >= max_chars:
+            break
+    return " ".join(parts)
+
+
+URL_RE = re.compile(r"https?://[^\s<>\"']+")
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+NON_WORD = re.compile(r"[^\w\s]")
+
+
+def dedupe_sections(*sections, max_chars=1500) -> list[str]:
+    seen = set()
+    deduped = []
+    for text in sections:
+        kept = []
+        for sentence in SENTENCE_SPLIT.split(text):
+            key = NON_WORD.sub("", sentence).lower().strip()
+            if key and key not in seen:
+                seen.add(key)
+                kept.append(sentence)
+        deduped.append(limit_text(" ".join(kept), max_chars))
+    return deduped
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def cached_tavily(query, depth):
+    return limit_text(
+        tavily_text(
+            get_tavily().search(
+                query,
+                search_depth=depth,
+                max_results=5,
+                include_answer=False
+            )
+        )
     )
 
 
 
 
-analysis_prompt = ChatPromptTemplate.from_messages([
-    ("system", """
+# kept byte-identical across calls so provider-side prefix caching can hit
+SYSTEM_MSG = SystemMessage(content="""
 You are an evidence-based market research analyst.
 
 Rules:
@@ -88,8 +193,9 @@ Rules:
 - No stock predictions
 - Future plans must be explicitly announced
 - Be neutral and professional
-"""),
-    ("human", """
+""")
+
+USER_TMPL = PromptTemplate.from_template("""
 Company Overview:
 {overview}
 
@@ -106,86 +212,143 @@ Stock News:
 {stock_news}
 
 Generate a structured company research report.
+""")
 
-Also include:
-- Risks & Limitations (no speculation)
-- Confidence Level (HIGH / MEDIUM / LOW with reason)
 
-Sources:
-- Each source MUST be a valid https:// URL
-""")
-])
+def start_pdf(company: str, created_at: str):
+    buf = BytesIO()
+    pdf = SimpleDocTemplate(buf, pagesize=A4)
+    styles = getSampleStyleSheet()
+    header = [
+        Paragraph(f"{company} Research Report", styles["Title"]),
+        Paragraph(f"<i>Created on: {created_at}</i>", styles["Normal"]),
+    ]
+    return buf, pdf, styles, header
 
 
-def generate_report(company: str) -> str:
+# fewer sections than this may mean a search failed, so the report isn't cached
+MIN_SEARCH_SECTIONS = 3
 
-    tavily = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
 
-    def safe_tavily(query, depth="advanced"):
-        try:
-            return limit_text(
-                tavily_text(
-                    tavily.search(query, search_depth=depth)
+async def search_company(company: str) -> list[str]:
+
+    async def safe_tavily(sem, query, depth="basic"):
+        async with sem:
+            try:
+                return await asyncio.to_thread(
+                    cached_tavily, query, depth
                 )
-            )
-        except Exception:
-            return ""
+            except Exception:
+                return ""
+
+    # bounded so the fan-out stays within Tavily rate limits
+    sem = asyncio.Semaphore(5)
+    return await asyncio.gather(
+        safe_tavily(sem, f"{company} company overview"),
+        safe_tavily(sem, f"{company} recent news"),
+        safe_tavily(sem, f"{company} earnings", "advanced"),
+        safe_tavily(sem, f"{company} future plans"),
+        safe_tavily(sem, f"{company} stock news"),
+    )
+
 
-    overview = safe_tavily(f"{company} company overview", "basic")
-    news = safe_tavily(f"{company} recent news")
-    earnings = safe_tavily(f"{company} earnings")
-    future_plans = safe_tavily(f"{company} future plans")
-    stock_news = safe_tavily(f"{company} stock news")
+def write_report(results: list[str]) -> CompanyReport:
+    overview, news, earnings, future_plans, stock_news = dedupe_sections(*results)
 
     if not overview:
         overview = "Company overview information not available."
 
-    messages = analysis_prompt.format_messages(
-        overview=overview,
-        news=news,
-        earnings=earnings,
-        future_plans=future_plans,
-        stock_news=stock_news
-    )
+    messages = [
+        SYSTEM_MSG,
+        HumanMessage(content=USER_TMPL.format(
+            overview=overview,
+            news=news,
+            earnings=earnings,
+            future_plans=future_plans,
+            stock_news=stock_news
+        ))
+    ]
+
+    report = get_llm().invoke(messages)
+    report.sources = [src for src in report.sources if URL_RE.fullmatch(src)]
+    return report
+
+
+@st.cache_data(ttl=1800, show_spinner=False)
+def build_report(company: str, _results: list[str]) -> CompanyReport:
+    # keyed on company only; the searches behind it are cached separately
+    return write_report(_results)
+
+
+def render_pdf(report: CompanyReport, buf, pdf, styles, header) -> bytes:
+    normal, h2 = styles["Normal"], styles["Heading2"]
+
+    def section(heading, content):
+        return [
+            Spacer(1, 12),
+            Paragraph(f"<b>{heading}</b>", h2),
+            Paragraph(content, normal),
+        ]
+
+    sections = [
+        section("Company Overview", report.company_overview),
+        section("Recent Developments", "<br/>".join(f"• {escape(i)}" for i in report.recent_developments)),
+        section("Earnings Summary", report.earnings_summary),
+        section("Future Plans", report.future_plans),
+        section("Stock Context", report.stock_context),
+        section("Risks & Limitations", report.risks_and_limitations),
+        section("Confidence Level", report.confidence_level),
+        section("Sources", "<br/>".join(
+            f'• <a href="{escape(src)}">{escape(src)}</a>' for src in report.sources
+        )),
+    ]
+    story = [*header, *sum(sections, [])]
 
-    structured_llm = llm.with_structured_output(CompanyReport)
-    report: CompanyReport = structured_llm.invoke(messages)
+    pdf.build(story)
 
+    return buf.getvalue()
 
-    created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
-    file_name = f"{company}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.pdf"
 
-    pdf = SimpleDocTemplate(file_name, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+def generate_report(company: str) -> tuple[bytes, str, datetime]:
+    now = datetime.now(timezone.utc)
+    created_at = now.strftime("%Y-%m-%d %H:%M UTC")
+    file_name = f"{company}_{now.strftime('%Y%m%d_%H%M%S')}.pdf"
 
-    def section(title, content):
-        story.append(Spacer(1, 12))
-        story.append(Paragraph(f"<b>{title}</b>", styles["Heading2"]))
-        story.append(Paragraph(content, styles["Normal"]))
+    # the PDF scaffolding needs no research, so it is set up during the searches
+    executor = get_executor()
+    pdf_setup = executor.submit(start_pdf, company, created_at)
+    results = asyncio.run(search_company(company))
 
-    story.append(Paragraph(f"{company} Research Report", styles["Title"]))
-    story.append(Paragraph(f"<i>Created on: {created_at}</i>", styles["Normal"]))
+    # thin evidence may come from a failed search, so that report is not cached
+    if sum(1 for text in results if text) >= MIN_SEARCH_SECTIONS:
+        report = build_report(company, results)
+    else:
+        report = write_report(results)
 
-    section("Company Overview", report.company_overview)
+    return render_pdf(report, *pdf_setup.result()), file_name, now
 
-    section("Recent Developments", "<br/>".join(f"- {i}" for i in report.recent_developments))
-    section("Earnings Summary", report.earnings_summary)
-    section("Future Plans", report.future_plans)
-    section("Stock Context", report.stock_context)
 
+def insert_reports(rows):
+    # one transaction for the whole batch, so a bulk import pays a single commit
+    with get_db().writer() as conn, conn:
+        conn.executemany(
+            "INSERT INTO reports (company, pdf_path, created_at) VALUES (?, ?, ?)",
+            rows
+        )
+    count_reports.clear()
 
-    section("Risks & Limitations", report.risks_and_limitations)
-    section("Confidence Level", report.confidence_level)
 
-    story.append(Spacer(1, 12))
-    story.append(Paragraph("<b>Sources</b>", styles["Heading2"]))
-    for src in report.sources:
-        story.append(Paragraph(f'<a href="{src}">{src}</a>', styles["Normal"]))
+@st.cache_data(show_spinner=False)
+def count_reports() -> int:
+    # COUNT(*) is a full scan, so it only runs again after an insert
+    with get_db().reader() as conn:
+        return conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
 
-    pdf.build(story)
 
-    return file_name
+def save_report(company: str, file_name: str, created_at: datetime):
+    insert_reports([
+        (company, file_name, created_at.strftime("%Y-%m-%d %H:%M:%S"))
+    ])
 
 
 
@@ -210,32 +373,49 @@ with tab1:
             st.error("Please enter a company name")
         else:
             with st.spinner("Collecting data and generating report..."):
-                pdf_path = generate_report(company)
+                pdf_bytes, file_name, created_at = generate_report(company)
 
-                cursor.execute(
-                    "INSERT INTO reports (company, pdf_path, created_at) VALUES (?, ?, ?)",
-                    (company, pdf_path, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
-                )
-                conn.commit()
+            # the download is served from memory, so the file is written while the page renders
+            writing = get_executor().submit(Path(file_name).write_bytes, pdf_bytes)
 
             st.success("Report generated successfully")
 
-            with open(pdf_path, "rb") as f:
-                st.download_button(
-                    "⬇ Download PDF",
-                    f,
-                    file_name=pdf_path,
-                    mime="application/pdf",
-                    use_container_width=True
-                )
+            st.download_button(
+                "⬇ Download PDF",
+                pdf_bytes,
+                file_name=file_name,
+                mime="application/pdf",
+                use_container_width=True
+            )
+
+            try:
+                writing.result()
+            except OSError as e:
+                st.warning(f"Report could not be saved to history: {e}")
+            else:
+                save_report(company, file_name, created_at)
+
 
 
 
 with tab2:
-    cursor.execute(
-        "SELECT company, pdf_path, created_at FROM reports ORDER BY created_at DESC"
-    )
-    rows = cursor.fetchall()
+    total = count_reports()
+
+    page = 1
+    if total > HISTORY_PAGE_SIZE:
+        page = st.number_input(
+            "Page",
+            min_value=1,
+            max_value=-(-total // HISTORY_PAGE_SIZE),
+            value=1
+        )
+
+    with get_db().reader() as conn:
+        rows = conn.execute(
+            "SELECT company, pdf_path, created_at FROM reports "
+            "ORDER BY created_at DESC LIMIT ? OFFSET ?",
+            (HISTORY_PAGE_SIZE, (page - 1) * HISTORY_PAGE_SIZE)
+        ).fetchall()
 
     if not rows:
         st.info("No reports generated yet")
@@ -245,10 +425,10 @@ with tab2:
                 st.markdown(f"**{company}**")
                 st.caption(f"Generated on {date}")
                 if os.path.exists(pdf):
-                    with open(pdf, "rb") as f:
-                        st.download_button(
-                            "⬇ Download",
-                            f,
-                            file_name=pdf,
-                            mime="application/pdf"
-                        )
+                    # a callable is only read when the button is clicked
+                    st.download_button(
+                        "⬇ Download",
+                        Path(pdf).read_bytes,
+                        file_name=pdf,
+                        mime="application/pdf"
+                    )
@@ -0,0 +1,22 @@
+from typing import List
+
+from pydantic import BaseModel, Field
+
+
+class CompanyReport(BaseModel):
+    company_overview: str
+    recent_developments: List[str]
+    earnings_summary: str
+    future_plans: str
+    stock_context: str
+    sources: List[str] = Field(
+        description="https:// URLs of the pages the facts came from"
+    )
+
+
+    risks_and_limitations: str = Field(
+        description="Key risks, uncertainties, and data limitations (no speculation)"
+    )
+    confidence_level: str = Field(
+        description="HIGH / MEDIUM / LOW confidence with brief justification"
+    )